@@ -1,11 +1,21 @@
 import streamlit as st
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, InternalServerError, OpenAI, RateLimitError
+from PIL import Image
+from pydantic import BaseModel, ValidationError
+import numpy as np
+import asyncio
 import base64
+import hashlib
 import io
 import json
-import math
+import queue
+import re
+import threading
+import time
+from collections import deque
+from typing import List, Optional
 
 # --- Load API Key from .env ---
 load_dotenv()
@@ -14,117 +24,579 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 # --- Initialize OpenRouter Client ---
 # The base_url needs to point to OpenRouter for their API
 # Note: If OpenRouter changes their base_url in the future, you'd update it here.
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=OPENROUTER_API_KEY,
-)
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+# Cached as a resource so the same client, and its HTTP/2 keep-alive connection pool,
+# survives Streamlit reruns instead of paying a fresh TCP/TLS handshake on every rerun.
+@st.cache_resource
+def get_client():
+    return OpenAI(
+        base_url=OPENROUTER_BASE_URL,
+        api_key=OPENROUTER_API_KEY,
+        timeout=60,
+        max_retries=3,
+        http_client=DefaultHttpxClient(http2=True),
+    )
+
+# Async client used when several images are uploaded at once.
+# Created per batch: an async connection pool is bound to the event loop that asyncio.run() creates,
+# so one shared client would break on the second multi-image upload.
+# SDK retries are off because analyze_one already retries with backoff; both together would multiply.
+def make_async_client():
+    return AsyncOpenAI(
+        base_url=OPENROUTER_BASE_URL,
+        api_key=OPENROUTER_API_KEY,
+        timeout=60,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(http2=True),
+    )
+
+# --- Connection warm-up ---
+# Opens the DNS + TCP + TLS + HTTP/2 connection to OpenRouter in the background while the user is
+# still choosing a file, so the first AI call reuses a warm connection from get_client()'s pool
+def warm_up_connection():
+    client = get_client().with_options(timeout=5, max_retries=0) # Shares the same connection pool
+
+    def ping():
+        try:
+            client.models.list()
+        except Exception:
+            pass # Best effort only; the real request will connect normally
+
+    threading.Thread(target=ping, daemon=True).start()
+
+# --- Parallel Request Limits ---
+# Keep these under your OpenRouter account limits
+MAX_CONCURRENT_REQUESTS = 10 # Upper bound on in-flight AI calls
+MAX_ATTEMPTS = 5 # Attempts per image before giving up
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) # Transient failures worth another attempt
+MAX_BATCH_SIZE = 8 # Images packed into one multi-image request (1024px thumbnails fit well inside the context window)
 
 # --- Hypothetical Solar Data (Context Management) ---
 # These values are illustrative and would be loaded from a database or more precise APIs in a real app
 PANEL_WATTAGE = 400 # Watts per panel
-PANEL_AREA_SQ_FT = 18 # Approximate area per panel in square feet (e.g., 6.5ft x 2.75ft)
+PANEL_AREA_SQ_FT = 18 # Approximate area per panel in square feet (e.g., 6.5ft x 2.75ft) - keep as an int, panel count uses integer division
 PANEL_COST_PER_WATT = 70.00 # Average cost per watt (INR) - this is an all-in cost for panels, inverter, installation
 AVG_ELECTRICITY_RATE_PER_KWH = 6.50 # Average electricity rate (INR per kWh)
 SYSTEM_LIFESPAN_YEARS = 25 # Typical lifespan for ROI calculation
 
-# --- Function to encode image to base64 for AI ---
-def encode_image(uploaded_file):
-    # Read the file into bytes
-    bytes_data = uploaded_file.getvalue()
-    # Encode bytes to base64 string
-    return base64.b64encode(bytes_data).decode('utf-8')
-
-# --- Function to call Vision AI for analysis and get JSON output ---
-def get_roof_analysis_from_ai(image_base64):
+# --- Derived Constants (precomputed once) ---
+# Assuming a system produces ~1.3-1.6 kWh per watt-peak per year in good conditions (simplified)
+# Using 1.4 as a base average for demonstration: 1.4 kWh per kW-peak = 1.4e-3 kWh per watt
+KWH_PER_W_PER_YEAR = 1.4e-3
+
+# --- Qualitative AI Labels to Numbers ---
+# The AI adds qualifiers ("very large", "moderately good"), so each label is scanned for these keywords.
+# When several appear, the first key in dict order wins, e.g. "medium-large" -> "large".
+USABLE_AREA_SQ_FT_MAP = {"large": 600, "medium": 300, "small": 100} # Unknown sizes map to 0
+PRODUCTION_FACTOR_MAP = {"excellent": 1.2, "moderate": 0.8, "poor": 0.5, "significant shading": 0.5} # Anything else, e.g. "good", maps to 1.0
+USABLE_AREA_KEYWORDS = re.compile(r"\b(" + "|".join(USABLE_AREA_SQ_FT_MAP) + ")")
+PRODUCTION_FACTOR_KEYWORDS = re.compile(r"\b(" + "|".join(PRODUCTION_FACTOR_MAP) + ")")
+
+# --- Image Preprocessing ---
+# The vision model works at roughly 1024px, so larger uploads are downscaled before sending
+MAX_IMAGE_SIDE = 1024 # Longest side in pixels
+JPEG_QUALITY = 85 # Re-encode quality for the AI payload
+
+# --- AI Result Models ---
+# The AI's JSON reply is parsed and validated in one pass by pydantic; defaults cover omitted keys
+class RoofAnalysis(BaseModel):
+    roof_shape: str = "N/A"
+    main_obstacles: List[str] = []
+    sunlight_exposure: str = "N/A"
+    usable_area_qualitative: str = "N/A"
+    overall_assessment: str = "N/A"
+
+# One result of a multi-image request; image_index says which image in the request it describes
+class RoofBatchItem(RoofAnalysis):
+    image_index: int
+
+class RoofBatchAnalysis(BaseModel):
+    results: List[RoofBatchItem]
+
+class AnalysisError(BaseModel):
+    error: str
+    raw_response: Optional[str] = None
+
+# Raised when the AI reply does not validate as a RoofAnalysis; keeps the raw text for debugging
+class InvalidAIResponse(ValueError):
+    def __init__(self, message, raw_response):
+        super().__init__(message)
+        self.raw_response = raw_response
+
+def parse_roof_analysis(ai_content):
+    try:
+        return RoofAnalysis.model_validate_json(ai_content)
+    except ValidationError as e:
+        raise InvalidAIResponse(str(e), ai_content) from e
+
+# --- Persistent AI Result Cache ---
+# Successful analyses are stored on disk keyed by the image hash, so re-uploading the same image skips the AI call
+AI_CACHE_DIR = ".cache"
+AI_CACHE_PATH = os.path.join(AI_CACHE_DIR, "roof_ai.jsonl")
+
+def load_ai_cache(path, key_field="digest", value_field="analysis"):
+    cache = {}
+    if not os.path.exists(path):
+        return cache
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                cache[entry[key_field]] = entry[value_field]
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue # Skip truncated or malformed lines
+    return cache
+
+# The cache is only an optimization: a failed disk write is reported but never fails the analysis.
+# The in-memory entry is kept on purpose, so this process still reuses the result until it restarts.
+def save_to_ai_cache(digest, analysis):
+    AI_CACHE[digest] = analysis
     try:
-        response = client.chat.completions.create(
-            model="openai/gpt-4o", # Using GPT-4o which has Vision capabilities
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": """Analyze this satellite image of a rooftop for solar panel installation potential.
-                        Identify the main rooftop area, approximate shape, and detect any significant obstructions like chimneys, vents, skylights, or trees casting shadows.
-                        Provide a qualitative assessment of sunlight exposure.
-                        Estimate the approximate usable area for solar panels qualitatively (e.g., "small", "medium", "large").
-                        Output the analysis in a JSON format with the following keys:
-                        - "roof_shape": (e.g., "rectangular", "L-shaped", "complex")
-                        - "main_obstacles": (list of strings, e.g., ["chimney", "vent", "tree shading"])
-                        - "sunlight_exposure": (e.g., "excellent", "good", "moderate", "poor - significant shading")
-                        - "usable_area_qualitative": (e.g., "small", "medium", "large")
-                        - "overall_assessment": (a concise summary string)
-                        Ensure the output is valid JSON, starting and ending with curly braces `{}`.
-                        """},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            },
+        os.makedirs(AI_CACHE_DIR, exist_ok=True)
+        with open(AI_CACHE_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"digest": digest, "analysis": analysis.model_dump()}) + "\n")
+    except OSError as e:
+        st.warning(f"Could not save the analysis to the local cache: {e}")
+
+def load_roof_analyses(path):
+    analyses = {}
+    for digest, analysis in load_ai_cache(path).items():
+        try:
+            analyses[digest] = RoofAnalysis.model_validate(analysis)
+        except ValidationError:
+            continue # Skip entries that no longer match the model
+    return analyses
+
+# Streamlit re-executes this script on every rerun; cache_resource makes the file be read and
+# validated once per process and hands every rerun the same (mutable) dict
+@st.cache_resource
+def get_ai_cache():
+    return load_roof_analyses(AI_CACHE_PATH)
+
+AI_CACHE = get_ai_cache()
+
+# --- Near-Duplicate Image Cache ---
+# Maps a perceptual hash of each analyzed image to the digest of its cached analysis, so the same
+# rooftop image rescaled or recompressed reuses the earlier result (a DCT pHash does not survive cropping)
+PHASH_CACHE_PATH = os.path.join(AI_CACHE_DIR, "roof_phash.jsonl")
+PHASH_SIZE = 16 # 16x16 low-frequency DCT coefficients -> 256-bit hash
+PHASH_MAX_DISTANCE = 24 # Max differing bits (of 256) to treat two images as the same rooftop
+
+# Like save_to_ai_cache, a failed disk write is reported and the in-memory entry is kept
+def save_to_phash_cache(phash, digest):
+    PHASH_CACHE[phash] = digest
+    try:
+        os.makedirs(AI_CACHE_DIR, exist_ok=True)
+        with open(PHASH_CACHE_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"phash": format(phash, "x"), "digest": digest}) + "\n")
+    except OSError as e:
+        st.warning(f"Could not save the image fingerprint to the local cache: {e}")
+
+def load_phash_cache(path):
+    phashes = {}
+    for phash, digest in load_ai_cache(path, "phash", "digest").items():
+        try:
+            phashes[int(phash, 16)] = digest
+        except (ValueError, TypeError):
+            continue # Skip hashes that are not hex strings
+    return phashes
+
+@st.cache_resource
+def get_phash_cache():
+    return load_phash_cache(PHASH_CACHE_PATH)
+
+PHASH_CACHE = get_phash_cache()
+
+# --- Function to hash the raw upload so identical uploads map to the same cache entry ---
+def hash_image(bytes_data: bytes) -> str:
+    return hashlib.blake2b(bytes_data, digest_size=16).hexdigest()
+
+# --- Function to decode and downscale an upload ---
+# Returns the decoded image (for the preview) and its JPEG re-encoding (for the AI payload)
+def downscale_image(bytes_data: bytes):
+    image = Image.open(io.BytesIO(bytes_data))
+    # Downscale and re-encode as JPEG to shrink the request body and vision token count
+    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return image, buffer.getvalue()
+
+# --- Function to encode image to base64 for AI ---
+def encode_image(bytes_data: bytes) -> str:
+    # Encode bytes to base64 string; base64 output is pure ASCII, so the cheaper ASCII decode is safe
+    return base64.b64encode(bytes_data).decode('ascii')
+
+# --- Perceptual hash (pHash) for near-duplicate detection ---
+# Orthonormal DCT-II basis for the pHash input size, built once
+PHASH_INPUT_SIZE = PHASH_SIZE * 4
+DCT_MATRIX = np.sqrt(2 / PHASH_INPUT_SIZE) * np.cos(np.pi * np.outer(np.arange(PHASH_INPUT_SIZE), 2 * np.arange(PHASH_INPUT_SIZE) + 1) / (2 * PHASH_INPUT_SIZE))
+DCT_MATRIX[0] /= np.sqrt(2)
+
+def perceptual_hash(image):
+    pixels = np.asarray(image.convert("L").resize((PHASH_INPUT_SIZE, PHASH_INPUT_SIZE), Image.Resampling.LANCZOS), dtype=float)
+    # Keep the low-frequency corner of the 2D DCT and threshold it at its median
+    low_frequencies = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:PHASH_SIZE, :PHASH_SIZE]
+    bits = (low_frequencies > np.median(low_frequencies)).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+# --- Function to find an already analyzed image that looks the same ---
+def find_similar_digest(phash):
+    best_digest, best_distance = None, PHASH_MAX_DISTANCE + 1
+    # PHASH_CACHE is shared with other sessions' threads, which may insert while this loops; iterate over a snapshot
+    for cached_phash, digest in list(PHASH_CACHE.items()):
+        distance = bin(phash ^ cached_phash).count("1") # Hamming distance
+        if distance < best_distance and digest in AI_CACHE:
+            best_digest, best_distance = digest, distance
+    return best_digest
+
+# --- Vision Models ---
+# The fast, cheap model answers most requests; the full model is only used when its reply is unusable
+MODEL_PRIMARY = "openai/gpt-4o-mini"
+MODEL_FALLBACK = "openai/gpt-4o"
+ANALYSIS_MODELS = (MODEL_PRIMARY, MODEL_FALLBACK)
+
+# Token accounting differs per model: gpt-4o-mini counts a 1024px image as ~25.5k input tokens
+# (2833 base + 5667 per tile), gpt-4o as ~765. Both budgets allow about 20 images per minute.
+ESTIMATED_TOKENS_PER_IMAGE = {MODEL_PRIMARY: 26000, MODEL_FALLBACK: 1500} # Image + prompt + response, until real usage is known
+MAX_TOKENS_PER_MINUTE = {MODEL_PRIMARY: 520000, MODEL_FALLBACK: 30000} # Keep under your OpenRouter account limits
+
+# --- Vision Prompt ---
+# Built once at import; every request reuses the same string.
+# The output keys are not described here: the JSON schema below carries them.
+ROOF_ANALYSIS_PROMPT = """Analyze this satellite image of a rooftop for solar panel installation potential.
+Identify the main rooftop area, approximate shape, and detect any significant obstructions like chimneys, vents, skylights, or trees casting shadows.
+Provide a qualitative assessment of sunlight exposure.
+Estimate the approximate usable area for solar panels qualitatively (e.g., "small", "medium", "large").
+"""
+
+# Prompt for several rooftops in one request; {count} and {last} are filled in per batch
+BATCH_PROMPT = """You are given {count} satellite images, each showing a different rooftop.
+Analyze every image separately for solar panel installation potential, exactly as you would a single image:
+identify the main rooftop area, approximate shape, significant obstructions (chimneys, vents, skylights, trees casting shadows),
+sunlight exposure, and the approximate usable area for solar panels.
+Each image is preceded by its label, "Image 0" to "Image {last}".
+Return exactly {count} results, one per image, and set each result's image_index to the number in the label of the image it describes.
+"""
+
+# --- Response Schemas ---
+# Strict JSON-schema mode makes the model emit exactly these keys, so the prompt does not have to spell them out
+ROOF_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "roof_shape": {"type": "string", "description": 'e.g., "rectangular", "L-shaped", "complex"'},
+        "main_obstacles": {"type": "array", "items": {"type": "string"}, "description": 'e.g., ["chimney", "vent", "tree shading"]'},
+        "sunlight_exposure": {"type": "string", "description": 'e.g., "excellent", "good", "moderate", "poor - significant shading"'},
+        "usable_area_qualitative": {"type": "string", "description": 'e.g., "small", "medium", "large"'},
+        "overall_assessment": {"type": "string", "description": "a concise summary"},
+    },
+    "required": ["roof_shape", "main_obstacles", "sunlight_exposure", "usable_area_qualitative", "overall_assessment"],
+    "additionalProperties": False,
+}
+
+ROOF_BATCH_ITEM_SCHEMA = {
+    **ROOF_ANALYSIS_SCHEMA,
+    "properties": {"image_index": {"type": "integer", "description": 'the number from the "Image N" label'}, **ROOF_ANALYSIS_SCHEMA["properties"]},
+    "required": ["image_index", *ROOF_ANALYSIS_SCHEMA["required"]],
+}
+
+ROOF_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": ROOF_BATCH_ITEM_SCHEMA}},
+    "required": ["results"],
+    "additionalProperties": False,
+}
+
+def json_schema_format(name, schema):
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+# --- Request payload shared by the sync and async AI calls ---
+def build_analysis_request(image_base64, model=MODEL_PRIMARY):
+    return {
+        "model": model, # Both models have Vision capabilities
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": ROOF_ANALYSIS_PROMPT},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/jpeg;base64,{image_base64}"
                         },
-                    ],
-                }
-            ],
-            max_tokens=500, # Limit the response length
-            response_format={"type": "json_object"} # Crucial for getting JSON output
-        )
-        # Extract the content and attempt to parse it as JSON
-        ai_content = response.choices[0].message.content
-        return json.loads(ai_content) # Parse the JSON string into a Python dictionary
-    except json.JSONDecodeError as e:
-        st.error(f"Failed to parse AI response as JSON: {e}. Raw response: {response.choices[0].message.content}")
-        return {"error": f"JSON parsing error: {e}", "raw_response": response.choices[0].message.content}
+                    },
+                ],
+            }
+        ],
+        "max_tokens": 500, # Limit the response length
+        "response_format": json_schema_format("roof_analysis", ROOF_ANALYSIS_SCHEMA), # Guarantees the keys RoofAnalysis expects
+    }
+
+# --- Request payload for several images in one call ---
+def build_batch_request(image_base64_list, model=MODEL_PRIMARY):
+    content = [{"type": "text", "text": BATCH_PROMPT.format(count=len(image_base64_list), last=len(image_base64_list) - 1)}]
+    for index, image_base64 in enumerate(image_base64_list):
+        # Label every image so each result can name the image it belongs to
+        content.append({"type": "text", "text": f"Image {index}:"})
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}})
+    return {
+        "model": model,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": 500 * len(image_base64_list), # Same per-image budget as a single request
+        "response_format": json_schema_format("roof_batch_analysis", ROOF_BATCH_SCHEMA),
+    }
+
+# --- Model fallback check ---
+# Returns the parsed analysis, or None when the primary model's reply should be retried on the fallback model.
+# The schema guarantees the keys, so this only triggers on replies cut off by max_tokens or refused outright.
+def accept_analysis(ai_content, model):
+    try:
+        return parse_roof_analysis(ai_content)
+    except InvalidAIResponse:
+        if model == MODEL_FALLBACK:
+            raise
+        return None
+
+# --- Streaming AI call for a single image ---
+# Yields the JSON response text as it arrives instead of waiting for the full completion
+def stream_roof_analysis(client, image_base64, model):
+    stream = client.chat.completions.create(**build_analysis_request(image_base64, model), stream=True)
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+# --- Run the streaming AI call on a worker thread ---
+# The worker reads the HTTP stream into a queue while the Streamlit script thread drains it
+# and updates the page, so network I/O and UI rendering overlap instead of taking turns
+STREAM_DONE = object()
+
+def stream_in_background(image_base64, model):
+    client = get_client() # Resolve the cached client on the script thread
+    chunks = queue.Queue()
+
+    def worker():
+        try:
+            for delta in stream_roof_analysis(client, image_base64, model):
+                chunks.put(delta)
+        except Exception as e:
+            chunks.put(e) # Re-raised on the script thread below
+        finally:
+            chunks.put(STREAM_DONE)
+
+    threading.Thread(target=worker, daemon=True).start()
+    while True:
+        item = chunks.get()
+        if item is STREAM_DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+# Matches "key": "value" pairs whose closing quote has already streamed in
+CLOSED_STRING_FIELD = re.compile(r'"(\w+)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+def closed_string_fields(partial_json):
+    return {key: json.loads(f'"{value}"') for key, value in CLOSED_STRING_FIELD.findall(partial_json)}
+
+# --- Function to stream the AI analysis into the page ---
+# Shows the raw response token-by-token and an early estimate as soon as the
+# area and sunlight fields are complete, then returns the parsed result
+def get_roof_analysis_streaming(image_base64, image_digest):
+    stream_area = st.empty()
+    early_estimate = st.empty()
+    received = []
+
+    def render_stream(model):
+        estimate_shown = False
+        for delta in stream_in_background(image_base64, model):
+            received.append(delta)
+            if not estimate_shown:
+                fields = closed_string_fields("".join(received))
+                if "usable_area_qualitative" in fields and "sunlight_exposure" in fields:
+                    calculations = perform_simplified_calculations(RoofAnalysis(usable_area_qualitative=fields["usable_area_qualitative"], sunlight_exposure=fields["sunlight_exposure"]))
+                    early_estimate.info(f"Early estimate: ~{calculations['estimated_panel_count']} panels, {calculations['estimated_system_wattage'] / 1000:.2f} kW system")
+                    estimate_shown = True
+            yield delta
+
+    try:
+        for model in ANALYSIS_MODELS:
+            received.clear()
+            early_estimate.empty()
+            with stream_area.container():
+                st.write_stream(render_stream(model))
+            analysis = accept_analysis("".join(received), model)
+            if analysis is not None:
+                break
+        save_to_ai_cache(image_digest, analysis)
+    except InvalidAIResponse as e:
+        st.error(f"Failed to parse AI response as JSON: {e}. Raw response: {e.raw_response}")
+        return AnalysisError(error=f"JSON parsing error: {e}", raw_response=e.raw_response)
     except Exception as e:
-        return {"error": f"Error during AI analysis: {e}"}
+        return AnalysisError(error=f"Error during AI analysis: {e}")
+    finally:
+        # The structured results replace the raw stream once it is complete
+        stream_area.empty()
+        early_estimate.empty()
 
-# --- Function for Simplified Calculations ---
-def perform_simplified_calculations(ai_analysis):
-    usable_area_qualitative = ai_analysis.get('usable_area_qualitative', 'N/A').lower()
-    sunlight_exposure = ai_analysis.get('sunlight_exposure', 'N/A').lower()
+    return analysis
+
+# --- Rolling token-per-minute throttle for parallel AI calls ---
+# One throttle per model is created for each analyze_images call; it does not cover other
+# sessions, other uploads in the same session, or the single-image streaming path
+class TokenThrottle:
+    def __init__(self, tokens_per_minute, tokens_per_image):
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens_per_image = tokens_per_image # Replaced by the real usage once a reply arrives
+        self.window = deque() # [timestamp, tokens] reservations from the last 60 seconds
+
+    def _used(self, now):
+        while self.window and now - self.window[0][0] > 60:
+            self.window.popleft()
+        return sum(tokens for _, tokens in self.window)
+
+    async def wait(self, image_count):
+        # Sleep until the projected request fits inside the rolling budget, then reserve it before
+        # the request is sent, so concurrent callers see each other's in-flight tokens
+        projected_tokens = self.tokens_per_image * image_count
+        while True:
+            now = time.monotonic()
+            if self._used(now) + projected_tokens <= self.tokens_per_minute or not self.window:
+                break
+            await asyncio.sleep(60 - (now - self.window[0][0]))
+        reservation = [now, projected_tokens]
+        self.window.append(reservation)
+        return reservation
+
+    def record(self, reservation, tokens, image_count):
+        # Replace the projected tokens with the real usage once the reply arrives,
+        # and project later requests from it
+        reservation[1] = tokens
+        self.tokens_per_image = tokens / image_count
+
+# --- Async AI call for a single image, with retries and rate limiting ---
+async def analyze_one(async_client, image_base64, image_digest, semaphore, throttles):
+    if image_digest in AI_CACHE:
+        return AI_CACHE[image_digest]
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            for model in ANALYSIS_MODELS:
+                async with semaphore:
+                    reservation = await throttles[model].wait(1)
+                    response = await async_client.chat.completions.create(**build_analysis_request(image_base64, model))
+                usage = getattr(response, "usage", None)
+                if usage:
+                    throttles[model].record(reservation, usage.total_tokens, 1)
+                analysis = accept_analysis(response.choices[0].message.content, model)
+                if analysis is not None:
+                    break
+            save_to_ai_cache(image_digest, analysis)
+            return analysis
+        except InvalidAIResponse as e:
+            return AnalysisError(error=f"JSON parsing error: {e}", raw_response=e.raw_response)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                return AnalysisError(error=f"Error during AI analysis: {e}")
+            await asyncio.sleep(2 ** attempt) # Exponential backoff: 1s, 2s, 4s, 8s
+        except Exception as e:
+            # Permanent failures (bad key, bad request, no access) would fail again on every retry
+            return AnalysisError(error=f"Error during AI analysis: {e}")
+
+# --- Async AI call for a group of images packed into a single request ---
+# Any image the combined reply does not cover properly is re-analyzed on its own with analyze_one,
+# which also brings in the retries and the fallback model
+async def analyze_group(async_client, group, semaphore, throttles):
+    if len(group) == 1:
+        return [await analyze_one(async_client, *group[0], semaphore, throttles)]
 
+    results = [None] * len(group)
+    try:
+        async with semaphore:
+            reservation = await throttles[MODEL_PRIMARY].wait(len(group))
+            response = await async_client.chat.completions.create(**build_batch_request([image_base64 for image_base64, _ in group]))
+        usage = getattr(response, "usage", None)
+        if usage:
+            throttles[MODEL_PRIMARY].record(reservation, usage.total_tokens, len(group))
+        batch = RoofBatchAnalysis.model_validate_json(response.choices[0].message.content)
+        # Match results to images by image_index; indices that are out of range or
+        # claimed by more than one result are left for the per-image retry
+        claims = [item.image_index for item in batch.results]
+        for item in batch.results:
+            index = item.image_index
+            if 0 <= index < len(group) and claims.count(index) == 1:
+                analysis = RoofAnalysis.model_validate(item.model_dump(exclude={"image_index"}))
+                save_to_ai_cache(group[index][1], analysis)
+                results[index] = analysis
+    except Exception:
+        pass # Everything is retried image by image below
+
+    retry = [index for index, result in enumerate(results) if result is None]
+    retried = await asyncio.gather(*[analyze_one(async_client, *group[index], semaphore, throttles) for index in retry])
+    for index, result in zip(retry, retried):
+        results[index] = result
+    return results
+
+async def analyze_batch(images):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    throttles = {model: TokenThrottle(MAX_TOKENS_PER_MINUTE[model], ESTIMATED_TOKENS_PER_IMAGE[model]) for model in ANALYSIS_MODELS}
+    results = [AI_CACHE.get(image_digest) for _, image_digest in images]
+    # Group uncached images of similar payload size, so each request carries comparable images
+    misses = sorted((index for index, result in enumerate(results) if result is None), key=lambda index: len(images[index][0]))
+    groups = [misses[start:start + MAX_BATCH_SIZE] for start in range(0, len(misses), MAX_BATCH_SIZE)]
+    async with make_async_client() as async_client:
+        group_results = await asyncio.gather(*[analyze_group(async_client, [images[index] for index in group], semaphore, throttles) for group in groups])
+    for group, group_result in zip(groups, group_results):
+        for index, result in zip(group, group_result):
+            results[index] = result
+    return results
+
+# --- Function to analyze several images concurrently ---
+# Uncached images are packed up to MAX_BATCH_SIZE per request and the requests run in parallel.
+# images is a list of (image_base64, image_digest) tuples; results come back in the same order
+def analyze_images(images):
+    return asyncio.run(analyze_batch(images))
+
+def keyword_lookup(label, keywords, mapping, default):
+    found = set(keywords.findall(label.lower()))
+    return next((value for key, value in mapping.items() if key in found), default)
+
+# --- Convert the AI's qualitative labels into the numeric calculation inputs ---
+def qualitative_inputs(ai_analysis):
     # Simple mapping of qualitative area to estimated square footage
-    if "large" in usable_area_qualitative:
-        estimated_usable_sq_ft = 600
-    elif "medium" in usable_area_qualitative:
-        estimated_usable_sq_ft = 300
-    elif "small" in usable_area_qualitative:
-        estimated_usable_sq_ft = 100
-    else:
-        estimated_usable_sq_ft = 0 # Default if unknown
+    estimated_usable_sq_ft = keyword_lookup(ai_analysis.usable_area_qualitative, USABLE_AREA_KEYWORDS, USABLE_AREA_SQ_FT_MAP, 0) # Default if unknown
+    # Adjust production based on sunlight exposure (very simplified)
+    production_factor = keyword_lookup(ai_analysis.sunlight_exposure, PRODUCTION_FACTOR_KEYWORDS, PRODUCTION_FACTOR_MAP, 1.0) # default for 'good'
+    return estimated_usable_sq_ft, production_factor
+
+# --- Numeric core of the estimates ---
+# Pure arithmetic with no string handling, so it works element-wise on NumPy arrays
+# (one entry per rooftop) as well as on single values
+def calculate_estimates(estimated_usable_sq_ft, production_factor):
+    estimated_usable_sq_ft = np.asarray(estimated_usable_sq_ft)
+    production_factor = np.asarray(production_factor, dtype=float)
 
     # Calculate estimated number of panels
-    if estimated_usable_sq_ft > 0:
-        estimated_panel_count = math.floor(estimated_usable_sq_ft / PANEL_AREA_SQ_FT)
-    else:
-        estimated_panel_count = 0
+    estimated_panel_count = estimated_usable_sq_ft // PANEL_AREA_SQ_FT # Both are ints, so this stays in integer arithmetic
 
     # Calculate estimated total system wattage
     estimated_system_wattage = estimated_panel_count * PANEL_WATTAGE
 
-    # Adjust production based on sunlight exposure (very simplified)
-    production_factor = 1.0 # default for 'good'
-    if "excellent" in sunlight_exposure:
-        production_factor = 1.2
-    elif "moderate" in sunlight_exposure:
-        production_factor = 0.8
-    elif "poor" in sunlight_exposure or "significant shading" in sunlight_exposure:
-        production_factor = 0.5 # significantly reduced
-
-    # Estimated yearly energy production (kWh)
-    # Assuming a system produces ~1.3-1.6 kWh per watt-peak per year in good conditions (simplified)
-    # Using 1.4 as a base average for demonstration, adjusted by production_factor
-    estimated_yearly_kwh = (estimated_system_wattage * 1.4 * production_factor) / 1000 if estimated_system_wattage > 0 else 0
+    # 1.0 for rooftops with a system, 0.0 otherwise; multiplying by it zeroes the
+    # outputs below without branching, so batches stay a single vectorized pass
+    has_system = (estimated_system_wattage > 0).astype(float)
+
+    # Estimated yearly energy production (kWh), adjusted by production_factor
+    estimated_yearly_kwh = estimated_system_wattage * KWH_PER_W_PER_YEAR * production_factor * has_system
 
     # Calculate estimated system cost
-    estimated_system_cost = (estimated_system_wattage / 1000) * PANEL_COST_PER_WATT * 1000 if estimated_system_wattage > 0 else 0 # Convert to kW for cost
+    estimated_system_cost = estimated_system_wattage * PANEL_COST_PER_WATT * has_system
 
     # Calculate estimated yearly savings
     estimated_yearly_savings = estimated_yearly_kwh * AVG_ELECTRICITY_RATE_PER_KWH
 
-    # Calculate simplified ROI (payback period)
-    if estimated_yearly_savings > 0:
-        estimated_roi_years = estimated_system_cost / estimated_yearly_savings
-    else:
-        estimated_roi_years = "N/A (No significant savings)"
+    # Calculate simplified ROI (payback period); NaN where there are no savings
+    estimated_roi_years = np.divide(estimated_system_cost, estimated_yearly_savings, out=np.full(estimated_system_cost.shape, np.nan), where=estimated_yearly_savings > 0)
 
     return {
         "estimated_usable_sq_ft": estimated_usable_sq_ft,
@@ -136,59 +608,145 @@ def perform_simplified_calculations(ai_analysis):
         "estimated_roi_years": estimated_roi_years,
     }
 
+# --- Function for Simplified Calculations over many rooftops at once ---
+# Runs one vectorized pass and returns one calculations dict per analysis
+def perform_batch_calculations(ai_analyses):
+    if not ai_analyses:
+        return []
+    inputs = [qualitative_inputs(ai_analysis) for ai_analysis in ai_analyses]
+    estimated_usable_sq_ft = np.array([usable_sq_ft for usable_sq_ft, _ in inputs], dtype=int)
+    production_factor = np.array([factor for _, factor in inputs], dtype=float)
+    columns = {key: value.tolist() for key, value in calculate_estimates(estimated_usable_sq_ft, production_factor).items()}
+    batch_calculations = [dict(zip(columns, row)) for row in zip(*columns.values())]
+    for calculations in batch_calculations:
+        if np.isnan(calculations["estimated_roi_years"]):
+            calculations["estimated_roi_years"] = "N/A (No significant savings)"
+    return batch_calculations
+
+# --- Function for Simplified Calculations (single rooftop) ---
+def perform_simplified_calculations(ai_analysis):
+    return perform_batch_calculations([ai_analysis])[0]
+
+# --- Function to render one image's AI analysis and estimates ---
+def display_analysis(ai_analysis_result, calculations=None):
+    if isinstance(ai_analysis_result, AnalysisError):
+        st.error(f"Analysis failed: {ai_analysis_result.error}")
+        if ai_analysis_result.raw_response is not None:
+            st.text("Raw AI Response (for debugging):")
+            st.code(ai_analysis_result.raw_response)
+        return
+
+    # Display the structured results from AI
+    st.write(f"**Roof Shape:** {ai_analysis_result.roof_shape}")
+    st.write(f"**Main Obstacles:** {', '.join(ai_analysis_result.main_obstacles) or 'None'}")
+    st.write(f"**Sunlight Exposure:** {ai_analysis_result.sunlight_exposure.capitalize()}")
+    st.write(f"**Usable Area (Qualitative):** {ai_analysis_result.usable_area_qualitative.capitalize()}")
+    st.write(f"**Overall Assessment:** {ai_analysis_result.overall_assessment}")
+
+    st.subheader("Simplified Solar Potential Estimates:")
+    # Perform and display simplified calculations, unless main already did them for the whole batch
+    if calculations is None:
+        calculations = perform_simplified_calculations(ai_analysis_result)
+
+    st.write(f"- **Estimated Usable Roof Area:** {calculations['estimated_usable_sq_ft']:.0f} sq ft")
+    st.write(f"- **Estimated Optimal Panel Count:** {calculations['estimated_panel_count']}")
+    st.write(f"- **Estimated System Size:** {calculations['estimated_system_wattage'] / 1000:.2f} kW")
+    st.write(f"- **Estimated Yearly Energy Production:** {calculations['estimated_yearly_kwh']:.0f} kWh")
+    st.write(f"- **Estimated System Cost:** ₹{calculations['estimated_system_cost']:.2f}")
+    st.write(f"- **Estimated Yearly Savings:** ₹{calculations['estimated_yearly_savings']:.2f}")
+    st.write(f"- **Estimated ROI (Payback Period):** {calculations['estimated_roi_years']:.1f} years" if isinstance(calculations['estimated_roi_years'], (int, float)) else calculations['estimated_roi_years'])
+
 def main():
     st.set_page_config(page_title="Rooftop Solar Analysis", layout="wide")
     st.write("WattMonk Assignment - AI-Powered Rooftop Solar Analysis Tool")
     st.title("☀️ AI-Powered Rooftop Solar Analysis Tool")
-    st.write("Upload a satellite image of a rooftop to assess its solar potential.")
+    st.write("Upload one or more satellite images of rooftops to assess their solar potential.")
+
+    # Analysis results for this session, keyed by the digest of the raw upload
+    if "results" not in st.session_state:
+        st.session_state.results = {}
+        st.session_state.near_duplicates = set() # Uploads whose result was reused from a near-identical image
 
-    uploaded_file = st.file_uploader("Choose a satellite image...", type=["jpg", "jpeg", "png"])
+    # Warm the API connection once per session, before the first upload arrives
+    if "connection_warmed" not in st.session_state:
+        st.session_state.connection_warmed = True
+        warm_up_connection()
 
-    if uploaded_file is not None:
-        st.image(uploaded_file, caption="Uploaded Satellite Image.", use_container_width=True)
-        st.success("Image uploaded successfully!")
+    uploaded_files = st.file_uploader("Choose satellite images...", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
+
+    if uploaded_files:
+        session_results = st.session_state.results
+        near_duplicates = st.session_state.near_duplicates
+        upload_digests = []
+        pending = [] # (image_base64, image_digest, upload_digest, phash) for uploads not yet analyzed in this session
+        for uploaded_file in uploaded_files:
+            raw = uploaded_file.getvalue()
+            upload_digest = hash_image(raw)
+            upload_digests.append(upload_digest)
+            caption = f"Uploaded Satellite Image: {uploaded_file.name}"
+            if upload_digest in session_results:
+                # Already analyzed in this session: show the upload as is and skip all image processing
+                st.image(raw, caption=caption, use_container_width=True)
+                continue
+            # Decode each new upload once; the same image feeds both the preview and the AI call
+            preview_image, jpeg_bytes = downscale_image(raw)
+            st.image(preview_image, caption=caption, use_container_width=True)
+            phash = perceptual_hash(preview_image)
+            image_digest = upload_digest
+            if upload_digest not in AI_CACHE:
+                # A near-duplicate of an already analyzed image reuses that image's cached result
+                similar_digest = find_similar_digest(phash)
+                if similar_digest is not None:
+                    image_digest = similar_digest
+                    near_duplicates.add(upload_digest)
+            pending.append((encode_image(jpeg_bytes), image_digest, upload_digest, phash))
+        st.success(f"{len(uploaded_files)} image(s) uploaded successfully!")
         st.info("Initiating solar analysis...")
 
-        image_base64 = encode_image(uploaded_file)
+        new_results = []
 
         with st.spinner("Analyzing rooftop with AI... This may take a moment."):
-            ai_analysis_result = get_roof_analysis_from_ai(image_base64) # This will now be a dictionary
-
-            st.subheader("AI-Powered Rooftop Analysis:")
+            if len(pending) == 1:
+                image_base64, image_digest, _, _ = pending[0]
+                if image_digest in AI_CACHE:
+                    new_results = [AI_CACHE[image_digest]]
+                else:
+                    # Uncached single image: stream the response so results appear progressively
+                    new_results = [get_roof_analysis_streaming(image_base64, image_digest)]
+            elif pending:
+                # Several images: run the AI calls concurrently
+                new_results = analyze_images([(image_base64, image_digest) for image_base64, image_digest, _, _ in pending])
 
-            if "error" in ai_analysis_result:
-                st.error(f"Analysis failed: {ai_analysis_result['error']}")
-                if "raw_response" in ai_analysis_result:
-                    st.text("Raw AI Response (for debugging):")
-                    st.code(ai_analysis_result['raw_response'])
+        # Keep successful results for the rest of the session; errors are retried on the next rerun
+        failed = {}
+        for (_, image_digest, upload_digest, phash), ai_analysis_result in zip(pending, new_results):
+            if isinstance(ai_analysis_result, RoofAnalysis):
+                session_results[upload_digest] = ai_analysis_result
+                # Remember the perceptual hash of every newly analyzed image
+                if phash not in PHASH_CACHE:
+                    save_to_phash_cache(phash, image_digest)
             else:
-                # Display the structured results from AI
-                st.write(f"**Roof Shape:** {ai_analysis_result.get('roof_shape', 'N/A')}")
-                st.write(f"**Main Obstacles:** {', '.join(ai_analysis_result.get('main_obstacles', ['None']))}")
-                st.write(f"**Sunlight Exposure:** {ai_analysis_result.get('sunlight_exposure', 'N/A').capitalize()}")
-                st.write(f"**Usable Area (Qualitative):** {ai_analysis_result.get('usable_area_qualitative', 'N/A').capitalize()}")
-                st.write(f"**Overall Assessment:** {ai_analysis_result.get('overall_assessment', 'N/A')}")
-
-                st.subheader("Simplified Solar Potential Estimates:")
-                # Perform and display simplified calculations
-                calculations = perform_simplified_calculations(ai_analysis_result)
-
-                st.write(f"- **Estimated Usable Roof Area:** {calculations['estimated_usable_sq_ft']:.0f} sq ft")
-                st.write(f"- **Estimated Optimal Panel Count:** {calculations['estimated_panel_count']}")
-                st.write(f"- **Estimated System Size:** {calculations['estimated_system_wattage'] / 1000:.2f} kW")
-                st.write(f"- **Estimated Yearly Energy Production:** {calculations['estimated_yearly_kwh']:.0f} kWh")
-                st.write(f"- **Estimated System Cost:** ₹{calculations['estimated_system_cost']:.2f}")
-                st.write(f"- **Estimated Yearly Savings:** ₹{calculations['estimated_yearly_savings']:.2f}")
-                st.write(f"- **Estimated ROI (Payback Period):** {calculations['estimated_roi_years']:.1f} years" if isinstance(calculations['estimated_roi_years'], (int, float)) else calculations['estimated_roi_years'])
-
-
-                st.write("\n---")
-                st.write("**Important Note on Estimates:**")
-                st.write("These calculations are simplified and based on hypothetical averages and qualitative AI assessments. For precise figures, a real-world tool would require:")
-                st.write("- Exact roof dimensions and angles (from precise image processing or CAD data).")
-                st.write("- Detailed local solar irradiance data (from geographical APIs).")
-                st.write("- Real-time local electricity rates and incentive programs.")
-                st.write("- Specific solar panel models and up-to-date installation costs.")
+                failed[upload_digest] = ai_analysis_result
+        ai_analysis_results = [session_results.get(upload_digest) or failed[upload_digest] for upload_digest in upload_digests]
+
+        # Estimate every successful rooftop in one vectorized pass
+        analyses = [ai_analysis_result for ai_analysis_result in ai_analysis_results if isinstance(ai_analysis_result, RoofAnalysis)]
+        batch_calculations = iter(perform_batch_calculations(analyses))
+
+        for uploaded_file, upload_digest, ai_analysis_result in zip(uploaded_files, upload_digests, ai_analysis_results):
+            st.subheader(f"AI-Powered Rooftop Analysis: {uploaded_file.name}")
+            if upload_digest in near_duplicates:
+                st.info("Reused the analysis of a near-identical image analyzed earlier.")
+            calculations = next(batch_calculations) if isinstance(ai_analysis_result, RoofAnalysis) else None
+            display_analysis(ai_analysis_result, calculations)
+
+        st.write("\n---")
+        st.write("**Important Note on Estimates:**")
+        st.write("These calculations are simplified and based on hypothetical averages and qualitative AI assessments. For precise figures, a real-world tool would require:")
+        st.write("- Exact roof dimensions and angles (from precise image processing or CAD data).")
+        st.write("- Detailed local solar irradiance data (from geographical APIs).")
+        st.write("- Real-time local electricity rates and incentive programs.")
+        st.write("- Specific solar panel models and up-to-date installation costs.")
 
 
 if __name__ == "__main__":